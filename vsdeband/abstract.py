@@ -1,9 +1,9 @@
 from __future__ import annotations
 
 from abc import abstractmethod
-from typing import Any
+from typing import Any, Sequence
 
-from vstools import inject_self, vs
+from vstools import CustomValueError, inject_self, vs
 
 __all__ = [
     'Debander'
@@ -15,3 +15,33 @@ class Debander:
     @inject_self
     def deband(self, clip: vs.VideoNode, **kwargs: Any) -> vs.VideoNode:
         ...
+
+    @inject_self
+    def deband_multi(
+        self, clip: vs.VideoNode, radius: Sequence[Any], thr: Sequence[Any], **kwargs: Any
+    ) -> list[vs.VideoNode]:
+        """
+        Chain multiple debanding passes, each one running on the output of the previous one.
+
+        Debanders able to run every pass inside a single filter call should override this.
+
+        :param clip:        Input clip.
+        :param radius:      Radius of each pass.
+        :param thr:         Threshold(s) of each pass.
+        :param kwargs:      Keyword arguments passed to every pass.
+
+        :return:            Output of every pass, in order.
+        """
+
+        if len(radius) != len(thr):
+            raise CustomValueError(
+                'You must pass the same number of radii and thresholds!', self.deband_multi, (radius, thr)
+            )
+
+        passes = list[vs.VideoNode]()
+
+        for rad, th in zip(radius, thr):
+            clip = self.deband(clip, radius=rad, thr=th, **kwargs)
+            passes.append(clip)
+
+        return passes
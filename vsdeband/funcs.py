@@ -1,16 +1,18 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from math import ceil
 from typing import Any
 
 from vsdenoise import Prefilter, frequency_merge
-from vsexprtools import ExprOp
+from vsexprtools import ExprOp, complexpr_available, norm_expr
 from vskernels import Scaler, ScalerT, Spline64
 from vsmasktools import FDoG, Morpho, flat_mask, texture_mask
 from vsrgtools import BlurMatrix, MeanMode, RemoveGrainMode, RemoveGrainModeT, box_blur, gauss_blur, limit_filter, removegrain
 from vstools import (
-    ColorRange, PlanesT, VSFunction, check_ref_clip, check_variable, depth, expect_bits, fallback, normalize_planes,
-    normalize_seq, scale_value, to_arr, vs
+    ColorRange, CustomIndexError, CustomValueError, FuncExceptT, PlanesT, VSFunction, check_ref_clip, check_variable,
+    core, depth, expect_bits, fallback, get_peak_value, get_prop, normalize_planes, normalize_seq, scale_value, to_arr,
+    vs
 )
 
 from .abstract import Debander
@@ -33,12 +35,90 @@ __all__ = [
 ]
 
 
+@lru_cache
+def _build_limit_expr(
+    thr: float, elast: float, peak: float, bright_thr: float | None = None,
+    flt: str = 'x', src: str = 'y', ref: str = 'z'
+) -> str:
+    """Build the `vsrgtools.limit_filter` expression for a plane, with the thresholds baked in."""
+
+    def _limit(limit_thr: float) -> str:
+        if limit_thr <= 0:
+            return src
+
+        limit_thr = limit_thr * peak / 255
+
+        if limit_thr >= peak:
+            return flt
+
+        if elast <= 1:
+            return f'{flt} {ref} - abs {limit_thr} <= {flt} {src} ?'
+
+        thr_elast = limit_thr * elast
+
+        return (
+            f'{flt} {ref} - abs {limit_thr} <= {flt} {flt} {ref} - abs {thr_elast} >= {src} '
+            f'{src} {flt} {src} - {thr_elast} {flt} {ref} - abs - * {1 / (thr_elast - limit_thr)} * + ? ?'
+        )
+
+    if bright_thr is None or bright_thr == thr:
+        return _limit(thr)
+
+    return f'{flt} {ref} > {_limit(bright_thr)} {_limit(thr)} ?'
+
+
+@lru_cache
+def _build_binarize_expr(bin_thr: float, peak: float) -> str:
+    """Build the suffix binarizing the value on top of the stack like `std.Binarize`."""
+
+    return f'{bin_thr} < 0 {peak} ?'
+
+
+def _prefetch_cache(clip: vs.VideoNode, prefetch: int | None, func: FuncExceptT) -> vs.VideoNode:
+    """Keep enough frames cached for every worker thread plus `prefetch` pipeline stages."""
+
+    if prefetch is None:
+        return clip
+
+    if prefetch < 0:
+        raise CustomValueError('"prefetch" can\'t be negative!', func, prefetch)
+
+    if core.num_threads <= 1:
+        return clip
+
+    size = prefetch + core.num_threads
+
+    return clip.std.SetVideoCache(mode=1, fixedsize=True, maxsize=size)
+
+
+def _debander_arg(debander: Debander, name: str, value: Any) -> list[Any]:
+    """Get the value a debander will actually use, as instance attributes take precedence over arguments."""
+
+    return to_arr(fallback(getattr(debander, name, None), value))
+
+
+@lru_cache
+def _morph_gradient_expr(rad: int) -> str:
+    """Maximum minus minimum of the square neighbourhood of size `2 * rad + 1`, using akarin's pixel access."""
+
+    pixels = [
+        f'x[{x},{y}]' if x or y else 'x' for y in range(-rad, rad + 1) for x in range(-rad, rad + 1)
+    ]
+
+    # Every neighbour is loaded once and updates both the running maximum and minimum
+    return ' '.join([
+        f'{pixels[0]} dup gmax! gmin!',
+        *(f'{pixel} px! gmax@ px@ max gmax! gmin@ px@ min gmin!' for pixel in pixels[1:]),
+        'gmax@ gmin@ -'
+    ])
+
+
 def mdb_bilateral(
     clip: vs.VideoNode, radius: int = 16,
     thr: int | list[int] = 260,
     lthr: int | tuple[int, int] = (153, 0), elast: float = 3.0,
     bright_thr: int | None = None,
-    debander: type[Debander] | Debander = F3kdb
+    debander: type[Debander] | Debander = F3kdb, prefetch: int | None = None, adaptive: bool = False
 ) -> vs.VideoNode:
     """
     Multi stage debanding, bilateral-esque filter.
@@ -53,6 +133,10 @@ def mdb_bilateral(
     :param elast:       Elasticity of the limiting. Refer to `vsrgtools.limit_filter`.
     :param bright_thr:  Limiting over the bright areas. Refer to `vsrgtools.limit_filter`.
     :param debander:    Specify what Debander to use. You can pass an instance with custom arguments.
+    :param prefetch:    Number of pipeline stages to keep cached on top of one frame per thread.
+                        Only applied on multithreaded cores. None to leave the cache to VapourSynth.
+    :param adaptive:    Pass through frames where every plane is flat, such as black frames, without debanding them.
+                        This adds a per-frame PlaneStats pass over the clip.
 
     :return:            Debanded clip.
     """
@@ -62,17 +146,38 @@ def mdb_bilateral(
     if not isinstance(debander, Debander):
         debander = debander()
 
+    if not any(_debander_arg(debander, 'thr', thr)) and not any(_debander_arg(debander, 'grain', 0)):
+        return clip
+
     clip, bits = expect_bits(clip, 16)
 
     rad1, rad2, rad3 = round(radius * 4 / 3), round(radius * 2 / 3), round(radius / 3)
 
-    db1 = debander.deband(clip, radius=rad1, thr=[max(1, th // 2) for th in to_arr(thr)], grain=0.0)
-    db2 = debander.deband(db1, radius=rad2, thr=thr, grain=0)
-    db3 = debander.deband(db2, radius=rad3, thr=thr, grain=0)
+    _, db2, db3 = debander.deband_multi(
+        clip, [rad1, rad2, rad3], [[max(1, th // 2) for th in to_arr(thr)], thr, thr], grain=0.0
+    )
 
     limit = limit_filter(db3, db2, clip, thr=lthr, elast=elast, bright_thr=bright_thr)
 
-    return depth(limit, bits)
+    if adaptive:
+        num_planes = clip.format.num_planes
+
+        probe = clip
+        for i in range(num_planes):
+            probe = probe.std.PlaneStats(plane=i, prop=f'PlaneStats{i}')
+
+        def _skip_flat(n: int, f: vs.VideoFrame) -> vs.VideoNode:
+            for i in range(num_planes):
+                if get_prop(f, f'PlaneStats{i}Min', int) != get_prop(f, f'PlaneStats{i}Max', int):
+                    return limit
+
+            return clip
+
+        out = limit.std.FrameEval(_skip_flat, probe, [clip, limit])
+    else:
+        out = limit
+
+    return _prefetch_cache(depth(out, bits), prefetch, mdb_bilateral)
 
 
 def masked_deband(
@@ -83,11 +188,14 @@ def masked_deband(
     rg_mode: RemoveGrainModeT = RemoveGrainMode.MINMAX_MEDIAN_OPP,
     debander: type[Debander] | Debander = F3kdb, **kwargs: Any
 ) -> vs.VideoNode:
-    clip, bits = expect_bits(clip, 16)
-
     if not isinstance(debander, Debander):
         debander = debander()
 
+    if not any(_debander_arg(debander, 'thr', thr)) and not any(_debander_arg(debander, 'grain', grain)):
+        return clip
+
+    clip, bits = expect_bits(clip, 16)
+
     deband_mask = deband_detail_mask(clip, sigma, rxsigma, pf_sigma, brz, rg_mode)
 
     deband = debander.deband(clip, radius=radius, thr=thr, grain=grain, **kwargs)
@@ -103,7 +211,7 @@ def pfdeband(
     lthr: int | tuple[int, int] = (76, 0), elast: float = 2.5,
     bright_thr: int | None = None, scaler: ScalerT = Spline64,
     prefilter: Prefilter | VSFunction = Prefilter.SCALEDBLUR(scale=1, radius=2),
-    debander: type[Debander] | Debander = F3kdb, **kwargs: Any
+    debander: type[Debander] | Debander = F3kdb, prefetch: int | None = None, **kwargs: Any
 ) -> vs.VideoNode:
     """
     Prefilter and deband a clip.
@@ -116,6 +224,8 @@ def pfdeband(
     :param bright_thr:  Limiting over the bright areas. Refer to `vsrgtools.limit_filter`.
     :param prefilter:   Prefilter used to blur the clip before debanding.
     :param debander:    Specify what Debander to use. You can pass an instance with custom arguments.
+    :param prefetch:    Number of pipeline stages to keep cached on top of one frame per thread.
+                        Only applied on multithreaded cores. None to leave the cache to VapourSynth.
 
     :return:            Debanded clip.
     """
@@ -125,6 +235,9 @@ def pfdeband(
     if not isinstance(debander, Debander):
         debander = debander()
 
+    if not any(_debander_arg(debander, 'thr', thr)) and not any(_debander_arg(debander, 'grain', 0)):
+        return clip
+
     scaler = Scaler.ensure_obj(scaler, pfdeband)
 
     clip, bits = expect_bits(clip, 16)
@@ -134,18 +247,31 @@ def pfdeband(
 
     deband = debander.deband(blur, radius=radius, thr=thr)
 
-    out = deband if change_res else clip
-
-    diff = out.std.MakeDiff(blur)
-
     if change_res:
-        diff = scaler.scale(diff, clip.width, clip.height)
+        diff = scaler.scale(deband.std.MakeDiff(blur), clip.width, clip.height)
+        out = clip.std.MergeDiff(diff)
     else:
-        out = limit_filter(deband, blur, thr=lthr, elast=elast, bright_thr=bright_thr)
+        lthr_y, lthr_c = lthr if isinstance(lthr, tuple) else (lthr, lthr)
+
+        for var, name, lower_bound in [
+            (lthr_y, 'lthr', 0), (lthr_c, 'lthr', 0), (fallback(bright_thr, 0), 'bright_thr', 0), (elast, 'elast', 1)
+        ]:
+            if var < lower_bound:
+                raise CustomIndexError(f'"{name}" must be >= {lower_bound}!', pfdeband, var)
+
+        # Limit the deband against the blur and merge back the source/blur difference, all in one pass.
+        # A zero threshold limits the deband back to the blur, so that plane is copied from the source.
+        peak = get_peak_value(clip)
+
+        exprs = (
+            f'{_build_limit_expr(lthr_y, elast, peak, bright_thr, "y", "z", "z")} x + z -'
+            if max(lthr_y, bright_thr or 0) > 0 else '',
+            f'{_build_limit_expr(lthr_c, elast, peak, None, "y", "z", "z")} x + z -' if lthr_c > 0 else ''
+        )
 
-    out = out.std.MergeDiff(diff)
+        out = norm_expr([clip, deband, blur], exprs) if any(exprs) else clip
 
-    return depth(out, bits)
+    return _prefetch_cache(depth(out, bits), prefetch, pfdeband)
 
 
 def guided_deband(
@@ -176,15 +302,29 @@ def guided_deband(
         deband = limit_filter(deband, clip, thr=tuple(map(int, to_arr(thr))))  # type: ignore
 
     if rad:
-        morpho = Morpho(planes)
-        rmask = ExprOp.SUB.combine(morpho.expand(clip, rad), morpho.inpand(clip, rad), planes=planes)
+        binarize = bool(bin_thr) and max(bin_thr) > 0
+
+        # The single expression grows quadratically with rad, past that the iterated 3x3 passes are cheaper
+        if complexpr_available and rad <= 3:
+            gradient = _morph_gradient_expr(rad)
+            peak = get_peak_value(clip, range_in=ColorRange.FULL)
+
+            rmask = norm_expr(clip, tuple(
+                f'{gradient} {_build_binarize_expr(thr_p, peak)}' if binarize else gradient for thr_p in bin_thr
+            ), planes)
+        else:
+            morpho = Morpho(planes)
+            rmask = ExprOp.SUB.combine(morpho.expand(clip, rad), morpho.inpand(clip, rad), planes=planes)
+
+            if binarize:
+                rmask = rmask.std.Binarize(threshold=bin_thr, planes=planes)
 
-        if bin_thr and max(bin_thr) > 0:
-            rmask = rmask.std.Binarize(threshold=bin_thr, planes=planes)
+        def _rg_modes(mode: RemoveGrainMode) -> list[RemoveGrainMode]:
+            return [mode if i in planes else RemoveGrainMode.NONE for i in range(clip.format.num_planes)]
 
-        rmask = removegrain(rmask, RemoveGrainMode.OPP_CLIP_AVG_FAST)
-        rmask = BlurMatrix.BINOMIAL()(rmask)
-        rmask = removegrain(rmask, RemoveGrainMode.MIN_SHARP)
+        rmask = removegrain(rmask, _rg_modes(RemoveGrainMode.OPP_CLIP_AVG_FAST))
+        rmask = BlurMatrix.BINOMIAL()(rmask, planes=planes)
+        rmask = removegrain(rmask, _rg_modes(RemoveGrainMode.MIN_SHARP))
 
         deband = deband.std.MaskedMerge(clip, rmask, planes=planes)
 
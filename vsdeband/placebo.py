@@ -3,7 +3,7 @@ from __future__ import annotations
 from dataclasses import dataclass
 from typing import Iterable
 
-from vstools import CustomIntEnum, KwargsT, check_variable, fallback, inject_self, join, normalize_seq, split, vs
+from vstools import CustomIntEnum, KwargsT, check_variable, fallback, inject_self, normalize_seq, vs
 
 from .abstract import Debander
 
@@ -121,12 +121,13 @@ class Placebo(Debander):
         set_grn = set(grain)
 
         if set_grn == {0} or clip.format.num_planes == 1:
-            debs = [_placebo(p, thr, grain[0], [0]) for p, thr in zip(split(clip), thr)]
+            thr = thr[:clip.format.num_planes]
 
-            if len(debs) == 1:
-                return debs[0]
+            debanded = clip
+            for thr_val in dict.fromkeys(thr):
+                debanded = _placebo(debanded, thr_val, grain[0], [i for i, t in enumerate(thr) if t == thr_val])
 
-            return join(debs, clip.format.color_family)
+            return debanded
 
         plane_map = {
             tuple(i for i in range(clip.format.num_planes) if grain[i] == x): x for x in set_grn - {0}